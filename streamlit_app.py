@@ -1,9 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import streamlit as st
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
-import altair as alt
 
 FASTAPI_URL = "https://web-production-c5eac.up.railway.app/backtest_mvp"
+REQUEST_TIMEOUT = (5, 60)  # (connect, read) seconds
+
+# === Shared HTTP session (keep-alive + connection pooling across reruns) ===
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+_SESSION = get_session()
+
+# === Cached backtest call (identical inputs skip the network on reruns) ===
+def _cache_key(payload):
+    return tuple(sorted(payload.items()))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_backtest(payload_tuple):
+    # Non-200 responses raise, so only successful results are cached
+    resp = _SESSION.post(FASTAPI_URL, json=dict(payload_tuple), timeout=REQUEST_TIMEOUT)
+    resp.raise_for_status()
+    try:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError as e:
+        # Surface as a RequestException, as resp.json() would have
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos, response=resp) from e
 
 st.set_page_config(page_title="AI Backtester", layout="wide")
 st.title("📈 SPY Rolling Strategy Backtester")
@@ -52,54 +81,57 @@ elif strategy == "rolling_zero_cost_collar":
     )
 
 # === Helper function to run one strategy ===
-def run_strategy(strategy_name, shares):
-    payload = {"ticker": ticker, "shares": shares, "strategy": strategy_name}
-    if strategy_name == "rolling_otm_puts":
-        payload["otm_percent"] = otm_percent or 5
-    elif strategy_name == "rolling_put_spread":
-        payload["spread_width_percent"] = spread_width_percent or 5
-    elif strategy_name == "rolling_collar":
-        payload["upside_cap_percent"] = upside_cap_percent or 10
-    elif strategy_name == "rolling_zero_cost_collar":
-        payload["coverage_ratio"] = coverage_ratio or 1.0
-
-    resp = requests.post(FASTAPI_URL, json=payload)
-    return resp.json() if resp.status_code == 200 else None
+def run_strategy(payload):
+    try:
+        return _fetch_backtest(_cache_key(payload))
+    except requests.RequestException:
+        return None
+
+# === Helper: run every strategy concurrently over the shared session ===
+def run_all_strategies(payloads):
+    jobs = list(payloads.items())
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as ex:
+        futures = {ex.submit(run_strategy, p): name for name, p in jobs}
+        for fut in as_completed(futures):
+            results[futures[fut]] = fut.result()
+    return results
 
 # === Helper: Buy & Hold baseline metrics ===
-def run_buy_and_hold(shares):
-    # Call any strategy (ATM) but only use stock_pnl
-    payload = {"ticker": ticker, "shares": shares, "strategy": "rolling_atm_puts"}
-    resp = requests.post(FASTAPI_URL, json=payload)
-    if resp.status_code != 200:
-        return None
-    data = resp.json()
-    if "results" not in data:
+def compute_buy_and_hold_metrics(results_list):
+    # Stock-only metrics from an already-fetched results list (only stock_pnl is used)
+    if not results_list:
         return None
 
-    df = pd.DataFrame(data["results"])
-    monthly_stock = df["stock_pnl"].tolist()
+    arr = np.asarray([r["stock_pnl"] for r in results_list], dtype=np.float64)
 
-    total_stock_pl = sum(monthly_stock)
-    cum_stock = df["stock_pnl"].cumsum()
-    running_max = cum_stock.cummax()
-    drawdowns = running_max - cum_stock
-    max_drawdown = drawdowns.max()
-    vol = df["stock_pnl"].std()
-    avg_monthly = df["stock_pnl"].mean()
-    risk_adj = avg_monthly / vol if vol > 0 else 0
+    total_stock_pl = arr.sum()
+    cum_stock = arr.cumsum()
+    max_drawdown = (np.maximum.accumulate(cum_stock) - cum_stock).max()
+    # Sample std (ddof=1), matching the previous pandas Series.std()
+    vol = arr.std(ddof=1) if arr.size > 1 else np.nan
+    avg_monthly = arr.mean()
 
     return {
         "Strategy": "Buy & Hold",
         "Final PnL": total_stock_pl,
         "Buy & Hold PnL": total_stock_pl,
         "Hedge PnL": 0,
-        "Win Rate %": (df["stock_pnl"] > 0).mean() * 100,
+        "Win Rate %": (arr > 0).mean() * 100,
         "Max Drawdown": max_drawdown,
         "Volatility": vol,
-        "Risk-Adjusted": risk_adj
+        "_avg_monthly": avg_monthly
     }
 
+# === Helper: shrink integer dtypes before handing frames to Arrow ===
+# Float columns are left as float64: float32 would show noise in displayed PnL
+def downcast_numeric(df):
+    def _downcast(col):
+        if col.dtype.kind == "i":
+            return pd.to_numeric(col, downcast="integer")
+        return col
+    return df.apply(_downcast)
+
 # === Single strategy run ===
 if st.sidebar.button("Run Backtest ✅"):
     payload = {
@@ -117,11 +149,14 @@ if st.sidebar.button("Run Backtest ✅"):
         payload["coverage_ratio"] = coverage_ratio
 
     with st.spinner("Running backtest..."):
-        resp = requests.post(FASTAPI_URL, json=payload)
-        if resp.status_code == 200:
-            data = resp.json()
+        try:
+            data = _fetch_backtest(_cache_key(payload))
+            error = None
+        except requests.RequestException as e:
+            data, error = None, e
+        if error is None:
             if "results" in data:
-                df = pd.DataFrame(data["results"])
+                df = downcast_numeric(pd.DataFrame(data["results"]))
                 st.success(data["status"])
 
                 # === Enhanced Summary ===
@@ -129,23 +164,29 @@ if st.sidebar.button("Run Backtest ✅"):
                     st.subheader("📊 Summary")
                     summary = data["summary"]
 
-                    c1, c2, c3 = st.columns(3)
-                    with c1:
-                        st.metric("Months Tested", summary.get("months", 0))
-                        st.metric("Win Rate %", summary.get("win_rate_percent", 0))
-                    with c2:
-                        st.metric("Buy & Hold Stock PnL", f"${summary.get('total_stock_pl',0):,.0f}")
-                        st.metric("Hedge Net PnL", f"${summary.get('total_hedge_pl',0):,.0f}")
-                    with c3:
-                        st.metric("Strategy Final PnL", f"${summary.get('total_strategy_pl',0):,.0f}")
-                        st.metric("Hedge vs Stock %", f"{summary.get('hedge_pct_of_stock',0):,.1f}%")
-
-                    # Risk metrics row
-                    r1, r2 = st.columns(2)
-                    with r1:
-                        st.metric("Max Drawdown", f"${summary.get('max_drawdown',0):,.0f}")
-                    with r2:
-                        st.metric("Monthly Volatility", f"${summary.get('monthly_volatility',0):,.0f}")
+                    summary_df = pd.DataFrame({
+                        "Metric": [
+                            "Months Tested",
+                            "Win Rate %",
+                            "Buy & Hold Stock PnL",
+                            "Hedge Net PnL",
+                            "Strategy Final PnL",
+                            "Hedge vs Stock %",
+                            "Max Drawdown",
+                            "Monthly Volatility"
+                        ],
+                        "Value": [
+                            f"{summary.get('months', 0)}",
+                            f"{summary.get('win_rate_percent', 0)}",
+                            f"${summary.get('total_stock_pl',0):,.0f}",
+                            f"${summary.get('total_hedge_pl',0):,.0f}",
+                            f"${summary.get('total_strategy_pl',0):,.0f}",
+                            f"{summary.get('hedge_pct_of_stock',0):,.1f}%",
+                            f"${summary.get('max_drawdown',0):,.0f}",
+                            f"${summary.get('monthly_volatility',0):,.0f}"
+                        ]
+                    })
+                    st.dataframe(summary_df, hide_index=True)
 
                     # Quick comparison chart
                     st.subheader("Buy & Hold vs Strategy")
@@ -164,16 +205,22 @@ if st.sidebar.button("Run Backtest ✅"):
                 # === Plot cumulative strategy vs stock PnL ===
                 if "total_pnl" in df.columns:
                     st.subheader("Cumulative Strategy vs Stock PnL")
-                    cum_df = pd.DataFrame({
-                        "Cumulative Strategy PnL": df["total_pnl"].cumsum(),
-                        "Cumulative Stock PnL": df["stock_pnl"].cumsum()
-                    })
+                    vals = df[["total_pnl", "stock_pnl"]].to_numpy(dtype=np.float64)
+                    cum_df = pd.DataFrame(
+                        np.cumsum(vals, axis=0),
+                        columns=["Cumulative Strategy PnL", "Cumulative Stock PnL"],
+                        index=df.index
+                    )
                     st.line_chart(cum_df)
 
             else:
                 st.error("No results returned!")
+        elif isinstance(error, requests.HTTPError):
+            st.error(f"Error {error.response.status_code}: {error.response.text}")
+        elif isinstance(error, requests.exceptions.InvalidJSONError):
+            st.error(f"Invalid JSON in backend response: {error}")
         else:
-            st.error(f"Error {resp.status_code}: {resp.text}")
+            st.error(f"Request failed: {error}")
 else:
     st.info("Choose your strategy and click **Run Backtest ✅**")
 
@@ -186,83 +233,100 @@ ALL_STRATEGIES = [
     "rolling_zero_cost_collar"
 ]
 
+COMPARE_COLUMNS = [
+    "Strategy",
+    "Final PnL",
+    "Buy & Hold PnL",
+    "Hedge PnL",
+    "Win Rate %",
+    "Max Drawdown",
+    "Volatility",
+    "_avg_monthly"  # temporary; turned into Risk-Adjusted once df_comp is built
+]
+
 if st.sidebar.button("Compare ALL Strategies 🚀"):
-    comp_results = []
+    # Only this branch draws Altair charts; defer the import until it is needed
+    import altair as alt
+
+    # One list per column so the DataFrame is built column-wise
+    comp_results = {col: [] for col in COMPARE_COLUMNS}
+
+    # Request payload per strategy, built once from the current inputs
+    extra_params = {
+        "rolling_otm_puts": {"otm_percent": otm_percent or 5},
+        "rolling_put_spread": {"spread_width_percent": spread_width_percent or 5},
+        "rolling_collar": {"upside_cap_percent": upside_cap_percent or 10},
+        "rolling_zero_cost_collar": {"coverage_ratio": coverage_ratio or 1.0}
+    }
+    payloads = {
+        strat: {"ticker": ticker, "shares": shares, "strategy": strat, **extra_params.get(strat, {})}
+        for strat in ALL_STRATEGIES
+    }
+
     with st.spinner("Running all strategies..."):
-        # Run Buy & Hold baseline first
-        bh_metrics = run_buy_and_hold(shares)
+        all_data = run_all_strategies(payloads)
+
+        # Buy & Hold baseline first, derived from the ATM response
+        atm_data = all_data.get("rolling_atm_puts") or {}
+        bh_metrics = compute_buy_and_hold_metrics(atm_data.get("results"))
         if bh_metrics:
-            comp_results.append(bh_metrics)
+            for col in COMPARE_COLUMNS:
+                comp_results[col].append(bh_metrics[col])
 
-        # Then run all hedging strategies
+        # Then all hedging strategies, in display order
         for strat in ALL_STRATEGIES:
-            data = run_strategy(strat, shares)
+            data = all_data.get(strat)
             if data and "summary" in data:
                 summary = data["summary"]
-                comp_results.append({
-                    "Strategy": strat,
-                    "Final PnL": summary["total_strategy_pl"],
-                    "Buy & Hold PnL": summary["total_stock_pl"],
-                    "Hedge PnL": summary["total_hedge_pl"],
-                    "Win Rate %": summary["win_rate_percent"],
-                    "Max Drawdown": summary["max_drawdown"],
-                    "Volatility": summary["monthly_volatility"],
-                    "Risk-Adjusted": (
-                        summary["avg_monthly_strategy_pl"] / summary["monthly_volatility"]
-                        if summary["monthly_volatility"] > 0 else 0
-                    )
-                })
-
-    if comp_results:
+                comp_results["Strategy"].append(strat)
+                comp_results["Final PnL"].append(summary["total_strategy_pl"])
+                comp_results["Buy & Hold PnL"].append(summary["total_stock_pl"])
+                comp_results["Hedge PnL"].append(summary["total_hedge_pl"])
+                comp_results["Win Rate %"].append(summary["win_rate_percent"])
+                comp_results["Max Drawdown"].append(summary["max_drawdown"])
+                comp_results["Volatility"].append(summary["monthly_volatility"])
+                comp_results["_avg_monthly"].append(summary["avg_monthly_strategy_pl"])
+
+    if comp_results["Strategy"]:
         df_comp = pd.DataFrame(comp_results)
+        avg_monthly = df_comp.pop("_avg_monthly")
+        df_comp["Risk-Adjusted"] = np.where(
+            df_comp["Volatility"] > 0, avg_monthly / df_comp["Volatility"], 0.0
+        )
 
         st.subheader("📊 Multi-Strategy Comparison")
-        st.dataframe(df_comp.style.format({
-            "Final PnL": "${:,.0f}",
-            "Buy & Hold PnL": "${:,.0f}",
-            "Hedge PnL": "${:,.0f}",
-            "Max Drawdown": "${:,.0f}",
-            "Volatility": "${:,.0f}",
-            "Risk-Adjusted": "{:.2f}"
-        }), use_container_width=True)
-
-        # Sort by Risk-Adjusted Return
-        best = df_comp.sort_values("Risk-Adjusted", ascending=False).iloc[0]
+        dollar_cols = ["Final PnL", "Buy & Hold PnL", "Hedge PnL", "Max Drawdown", "Volatility"]
+        dollars = st.column_config.NumberColumn(format="dollar")
+        # Round to whole dollars, as the previous "${:,.0f}" format displayed
+        st.dataframe(df_comp.round({col: 0 for col in dollar_cols}), column_config={
+            **{col: dollars for col in dollar_cols},
+            "Risk-Adjusted": st.column_config.NumberColumn(format="%.2f")
+        }, use_container_width=True)
+
+        # Highest Risk-Adjusted Return
+        best = df_comp.loc[df_comp["Risk-Adjusted"].idxmax()]
         st.success(f"🏆 Best Risk-Adjusted Strategy: **{best['Strategy']}**")
 
-        # === Final PnL: one bar per strategy ===
-        pnl_df = df_comp.copy()
+        # === Final PnL / Max Drawdown / Volatility: one faceted bar chart ===
         # For Buy & Hold row, Final PnL = Buy & Hold PnL
-        pnl_df.loc[pnl_df["Strategy"] == "Buy & Hold", "Final PnL"] = pnl_df.loc[
-            pnl_df["Strategy"] == "Buy & Hold", "Buy & Hold PnL"
-        ]
-        pnl_chart = alt.Chart(pnl_df).mark_bar().encode(
-            x=alt.X('Strategy:N', sort=None, title="Strategy"),
-            y=alt.Y('Final PnL:Q', title="Final PnL ($)"),
-            color=alt.Color('Strategy:N', legend=None)
+        final_pnl = df_comp["Final PnL"].where(
+            df_comp["Strategy"] != "Buy & Hold", df_comp["Buy & Hold PnL"]
         )
-        st.subheader("Final PnL Comparison")
-        st.altair_chart(pnl_chart, use_container_width=True)
-
-        # === Max Drawdown one bar per strategy ===
-        dd_df = df_comp[["Strategy", "Max Drawdown"]]
-        dd_chart = alt.Chart(dd_df).mark_bar().encode(
-            x=alt.X('Strategy:N', sort=None, title="Strategy"),
-            y=alt.Y('Max Drawdown:Q', title="Max Drawdown ($)"),
-            color=alt.Color('Strategy:N', legend=None)
+        metrics = ["Final PnL", "Max Drawdown", "Volatility"]
+        long_df = df_comp.assign(**{"Final PnL": final_pnl}).melt(
+            id_vars="Strategy",
+            value_vars=metrics,
+            var_name="Metric",
+            value_name="Value"
         )
-        st.subheader("Max Drawdown Comparison")
-        st.altair_chart(dd_chart, use_container_width=True)
-
-        # === Volatility one bar per strategy ===
-        vol_df = df_comp[["Strategy", "Volatility"]]
-        vol_chart = alt.Chart(vol_df).mark_bar().encode(
+        metrics_chart = alt.Chart(long_df).mark_bar().encode(
             x=alt.X('Strategy:N', sort=None, title="Strategy"),
-            y=alt.Y('Volatility:Q', title="Monthly Volatility ($)"),
-            color=alt.Color('Strategy:N', legend=None)
-        )
-        st.subheader("Volatility Comparison")
-        st.altair_chart(vol_chart, use_container_width=True)
+            y=alt.Y('Value:Q', title="$"),
+            color=alt.Color('Strategy:N', legend=None),
+            column=alt.Column('Metric:N', sort=metrics, title=None)
+        ).resolve_scale(y="independent")
+        st.subheader("Final PnL, Max Drawdown & Volatility Comparison")
+        st.altair_chart(metrics_chart)
 
     else:
         st.error("No strategy results returned.")